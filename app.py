@@ -1,324 +1,820 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g
+from flask.json.provider import JSONProvider
 from sqlalchemy import create_engine, text
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.exc import SQLAlchemyError
 import logging
-from datetime import datetime, date, time
+from datetime import datetime, date, time, timedelta
 from decimal import Decimal
+from collections import OrderedDict, defaultdict
+from dataclasses import dataclass
+from operator import itemgetter
+from typing import NamedTuple
+import functools
+import pathlib
+import orjson
 import json
-from collections import OrderedDict
-import requests
+import hashlib
+import base64
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from cachetools import TTLCache
+import os
+import sys
+from time import sleep
+import httpx
+import h2  # noqa: F401 -- required by the HTTP/2 OpenAI transport; fail at startup rather than mid-request
 
 app = Flask(__name__)
 
 # Setup logging
-logging.basicConfig(level=logging.DEBUG)
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "DEBUG"))
 logger = logging.getLogger(__name__)
 
-# Load configuration
-with open("config.json") as f:
-    config = json.load(f)
-
-DATABASE_URL = f"postgresql://{config['pguser']}:{config['pgpassword']}@{config['pghost']}:{config['pgport']}/{config['pgdatabase']}"
-RELATIONSHIPS = config["relationships"]
-
-# Setup database connection
-engine = create_engine(DATABASE_URL)
-Session = sessionmaker(bind=engine)
+# Configuration, the database engine and the OpenAI client are created on first use rather than at import,
+# keeping imports cheap for every worker process gunicorn forks
+class Config(NamedTuple):
+    database_url: str
+    relationships: dict
+    headers: dict
+    table_plans: dict
+
+@functools.cache
+def load_config():
+    config = orjson.loads(pathlib.Path("config.json").read_bytes())
+    database_url = f"postgresql://{config['pguser']}:{config['pgpassword']}@{config['pghost']}:{config['pgport']}/{config['pgdatabase']}"
+    relationships = config["relationships"]
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {config['openai_api_key']}"
+    }
+    table_plans = {table: build_table_plan(table, table_relationships) for table, table_relationships in relationships.items()}
+    return Config(database_url, relationships, headers, table_plans)
+
+# Setup database connection pool
+@functools.cache
+def get_engine():
+    return create_engine(
+        load_config().database_url,
+        pool_size=10,
+        max_overflow=20,
+        pool_pre_ping=True,
+        pool_recycle=1800,
+        future=True
+    )
+
+Session = sessionmaker()
 
 # OpenAI API configuration
-openai_api_key = config['openai_api_key']
 openai_api_url = "https://api.openai.com/v1/chat/completions"
-headers = {
-    "Content-Type": "application/json",
-    "Authorization": f"Bearer {openai_api_key}"
-}
+openai_model = "gpt-4"
+
+# Pooled HTTP/2 client so OpenAI calls reuse connections instead of a TCP+TLS handshake per request.
+# The transport retries failed connection attempts; 429 and 5xx responses are retried in post_to_openai.
+@functools.cache
+def get_openai_client():
+    return httpx.Client(
+        headers=load_config().headers,
+        timeout=httpx.Timeout(30.0, connect=5.0),
+        transport=httpx.HTTPTransport(http2=True, retries=2, limits=httpx.Limits(max_keepalive_connections=20))
+    )
+
+OPENAI_MAX_RETRIES = 3
+OPENAI_RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+# The request keeps its pooled database connection while waiting, so never honour long Retry-After values
+OPENAI_MAX_RETRY_DELAY = 10
+
+# Completions cache: identical (record, message) pairs skip the OpenAI round-trip for a week
+completions_cache = TTLCache(maxsize=10_000, ttl=7 * 24 * 3600)
+completions_cache_lock = threading.Lock()
+
+# Semantic cache for near-duplicate messages, opt-in with SEMANTIC_CACHE=1 as it needs a local embedding model
+corrections_semantic_cache = None
+if os.environ.get("SEMANTIC_CACHE") == "1":
+    import semantic_cache
+    corrections_semantic_cache = semantic_cache.from_env()
+    # Messages are embedded on this pool while the request thread fetches the record. Under gevent (wsgi.py) the
+    # patched threads are greenlets, and ONNX inference in one would block the hub, so use gevent's executor
+    # backed by native threads there
+    executor_class = ThreadPoolExecutor
+    if "gevent" in sys.modules:
+        from gevent import monkey
+        if monkey.is_module_patched("threading"):
+            from gevent.threadpool import ThreadPoolExecutor as executor_class
+    embedding_executor = executor_class(max_workers=4, thread_name_prefix="embedding")
+
+# Table plans: the relationships config normalized once when it is loaded
+@dataclass(slots=True, frozen=True)
+class Relation:
+    """A relationship entry: a direct field of the table (ref_table is None) or a child node joined by foreign key."""
+    column: str
+    alias: str = None
+    ref_schema: str = None
+    ref_table: str = None
+    ref_column: str = None
+    ref_table_name: str = None
+    fields: tuple = ()  # ((db_column, alias), ...) of the referenced table
+
+@dataclass(slots=True, frozen=True)
+class TablePlan:
+    table: str
+    schema: str
+    main_table: str
+    relations: tuple
+    aliases: tuple  # record aliases in output order
+    get_aliases: object  # returns the values of `aliases` from a result row as a tuple
+    field_map: tuple  # ((alias, mapped key, db column), ...) used by map_fields_to_columns
+    pretty_names: dict  # alias -> name used in the response text
+
+def tuple_getter(keys):
+    """Like operator.itemgetter, but always returns a tuple."""
+    if not keys:
+        return lambda row: ()
+    getter = itemgetter(*keys)
+    if len(keys) == 1:
+        return lambda row: (getter(row),)
+    return getter
+
+def pretty_name(key):
+    return key.capitalize().replace('_', ' ')
+
+def build_table_plan(table, relationships):
+    schema, main_table = table.split('.')
+    relations = []
+    aliases = []
+    field_map = []
+    for column, info in relationships.items():
+        if 'ref' in info:
+            ref_schema, ref_table, ref_column = info['ref'].split('.')
+            fields = tuple((field, field_info['alias']) for field, field_info in info.get('fields', {}).items())
+            relations.append(Relation(column, None, ref_schema, ref_table, ref_column, f"{ref_schema}.{ref_table}", fields))
+            aliases.extend(alias for _, alias in fields)
+            field_map.extend((alias, column, field) for field, alias in fields)
+        else:
+            relations.append(Relation(column, info['alias']))
+            aliases.append(info['alias'])
+            field_map.append((info['alias'], table, column))
+    aliases = tuple(aliases)
+    pretty_names = {alias: pretty_name(alias) for alias in aliases}
+    return TablePlan(
+        table, schema, main_table, tuple(relations), aliases, tuple_getter(aliases), tuple(field_map), pretty_names
+    )
 
 # Utility functions
+def iso_duration(delta):
+    """Format a timedelta (interval column) as an ISO 8601 duration, e.g. P14DT2H30M."""
+    sign = "-" if delta < timedelta(0) else ""
+    delta = abs(delta)
+    hours, rest = divmod(delta.seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    seconds += delta.microseconds / 1_000_000
+    clock = "".join(f"{value:g}{unit}" for value, unit in ((hours, "H"), (minutes, "M"), (seconds, "S")) if value)
+    return f"{sign}P{delta.days}D" + (f"T{clock}" if clock else "")
+
 def serialize(obj):
+    """orjson fallback for the values it does not encode natively.
+
+    Datetimes are passed through to it as well, since orjson rejects times with a tzinfo (timetz columns).
+    Binary columns are base64 encoded. Any other type raises TypeError rather than leaking its repr.
+    """
     if isinstance(obj, (datetime, date, time)):
         return obj.isoformat()
     elif isinstance(obj, Decimal):
         return float(obj)
-    return obj
+    elif isinstance(obj, timedelta):
+        return iso_duration(obj)
+    elif isinstance(obj, (bytes, bytearray, memoryview)):
+        return base64.b64encode(obj).decode()
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
 
-def map_fields_to_columns(record, relationships):
-    """Map the fields in the JSON response back to the actual database column names based on the relationships config."""
-    mapped_columns = {}
+def dumps(obj, option=0):
+    return orjson.dumps(
+        obj, default=serialize, option=option | orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+    )
 
-    for table, columns in relationships.items():
-        mapped_columns[table] = {}
+class OrjsonProvider(JSONProvider):
+    """Flask JSON provider backed by orjson, used by request.json and jsonify."""
+    def dumps(self, obj, **kwargs):
+        return dumps(obj).decode()
 
-        # Direct fields under the parent node
-        if 'alias' in columns and columns['alias'] in record:
-            mapped_columns[table][columns['alias']] = record[columns['alias']]
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
-        # Fields within the child nodes
-        if 'fields' in columns:
-            for field, field_info in columns['fields'].items():
-                alias = field_info['alias']
-                if alias in record:
-                    mapped_columns[table][field] = record[alias]
+app.json = OrjsonProvider(app)
 
-    logger.debug(f"Mapped columns: {json.dumps(mapped_columns, indent=2)}")
+def map_fields_to_columns(record, plan):
+    """Map the fields in the JSON response back to the actual database column names based on the table plan.
+
+    Child node fields are keyed by the foreign key column of the relation; direct fields are keyed by the
+    schema-qualified name of the table itself. Keys without mapped fields read as empty dicts.
+    """
+    mapped_columns = defaultdict(dict)
+
+    for alias, key, column in plan.field_map:
+        if alias in record:
+            mapped_columns[key][column] = record[alias]
+
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Mapped columns: %s", dumps(mapped_columns, orjson.OPT_INDENT_2).decode())
     return mapped_columns
 
-def construct_query(table, id_name, id_value):
-    """Construct the SQL query to retrieve the data based on the relationships in the config."""
-    logger.info(f"Constructing query for table {table} with id {id_name} and value {id_value}")
-    schema, table_name = table.split('.')
+@functools.lru_cache(maxsize=1024)
+def construct_query(table, id_name):
+    """Construct the SQL query to retrieve the data based on the relationships in the config.
+
+    The id value is bound through the :id_value parameter, so the statement only depends on
+    (table, id_name) and is cached for the lifetime of the process.
+    """
+    logger.info(f"Constructing query for table {table} with id {id_name}")
+    plan = load_config().table_plans[table]
 
     columns = []
+    join_clauses = []
     alias_counter = 1
-    relationships = RELATIONSHIPS[table]
-    for column, ref_table_info in relationships.items():
-        if 'ref' in ref_table_info:  # Handling child nodes
-            ref_schema, ref_table, ref_column = ref_table_info['ref'].split('.')
-            ref_alias = f"{ref_table}_alias_{alias_counter}"
+    for relation in plan.relations:
+        if relation.ref_table is None:  # Handling direct fields under parent node
+            columns.append(f"{plan.table}.{relation.column} AS \"{relation.alias}\"")
+            logger.debug("Mapping parent: %s -> %s.%s with alias %s", relation.column, plan.table, relation.column, relation.alias)
+        else:  # Handling child nodes
+            ref_alias = f"{relation.ref_table}_alias_{alias_counter}"
             alias_counter += 1
-            ref_columns = [f"{ref_alias}.{ref_col} AS \"{ref_col_info['alias']}\"" for ref_col, ref_col_info in ref_table_info['fields'].items()]
+            ref_columns = [f"{ref_alias}.{ref_col} AS \"{alias}\"" for ref_col, alias in relation.fields]
             columns.extend(ref_columns)
-            logger.debug(f"Mapping child: {column} -> {ref_table_info['ref']} with fields {ref_columns}")
-        else:  # Handling direct fields under parent node
-            columns.append(f"{schema}.{table_name}.{column} AS \"{ref_table_info['alias']}\"")
-            logger.debug(f"Mapping parent: {column} -> {schema}.{table_name}.{column} with alias {ref_table_info['alias']}")
+            join_clauses.append(f"LEFT JOIN {relation.ref_table_name} AS {ref_alias} ON {plan.table}.{relation.column} = {ref_alias}.{relation.ref_column}")
+            logger.debug("Mapping child: %s -> %s.%s with fields %s", relation.column, relation.ref_table_name, relation.ref_column, ref_columns)
 
-    query = f"SELECT {', '.join(columns)} FROM {schema}.{table_name}"
-
-    join_clauses = []
-    alias_counter = 1
-    for column, ref_table_info in relationships.items():
-        if 'ref' in ref_table_info:  # Only join on child nodes
-            ref_schema, ref_table, ref_column = ref_table_info['ref'].split('.')
-            ref_alias = f"{ref_table}_alias_{alias_counter}"
-            alias_counter += 1
-            join_clauses.append(f"LEFT JOIN {ref_schema}.{ref_table} AS {ref_alias} ON {schema}.{table_name}.{column} = {ref_alias}.{ref_column}")
+    query = f"SELECT {', '.join(columns)} FROM {plan.table}"
 
     if join_clauses:
         query += " " + " ".join(join_clauses)
 
     # Extract just the column name from id_name (removing the fully qualified name)
     column_name = id_name.split('.')[-1]
-    query += f" WHERE {schema}.{table_name}.{column_name} = :id_value"
+    query += f" WHERE {plan.table}.{column_name} = :id_value"
 
     logger.info(f"Constructed query: {query}")
     return text(query)
 
 def process_message(session, table, id_name, id_value):
-    query = construct_query(table, id_name, id_value)
+    query = construct_query(table, id_name)
     try:
         result = session.execute(query, {'id_value': id_value}).mappings().fetchone()
         if not result:
             return None, "No record found."
 
-        ordered_record = OrderedDict()
-        relationships = RELATIONSHIPS[table]
-        for column, relationship in relationships.items():
-            if 'alias' in relationship and relationship['alias'] in result:
-                ordered_record[relationship['alias']] = serialize(result[relationship['alias']])
-            if 'fields' in relationship:
-                for field, field_info in relationship['fields'].items():
-                    alias = field_info['alias']
-                    ordered_record[alias] = serialize(result[alias])
-
-        logger.debug(f"Ordered record: {ordered_record}")
+        plan = load_config().table_plans[table]
+        # Serialized once here, so the record sent to OpenAI, the cache keys and the change
+        # comparison against the corrections all see the same JSON values
+        values = orjson.loads(dumps(plan.get_aliases(result)))
+        ordered_record = OrderedDict(zip(plan.aliases, values))
+
+        logger.debug("Ordered record: %s", ordered_record)
         return ordered_record, None
     except SQLAlchemyError as e:
         logger.error(f"Database error: {e}")
         return None, "Database error."
+    except TypeError as e:
+        logger.error(f"Unsupported column value: {e}")
+        return None, "Unsupported column type."
+
+@dataclass(slots=True)
+class UpdateOp:
+    """A pending UPDATE of a single row, identified by table, key column and key value."""
+    table: str
+    key_column: str
+    key_value: object
+    columns: dict
+
+@functools.lru_cache(maxsize=256)
+def fetch_row_query(table, key_column):
+    return text(f"SELECT * FROM {table} WHERE {key_column} = :id_value")
+
+# Types without their modifier: casting to varchar(n) or numeric(p, s) would silently truncate or round
+# values the column itself rejects, CAST(x AS character varying) lets the UPDATE report them instead
+table_column_types_query = text(
+    "SELECT attname, format_type(atttypid, NULL) FROM pg_attribute "
+    "WHERE attrelid = CAST(:table AS regclass) AND attnum > 0 AND NOT attisdropped"
+)
+table_column_types_cache = {}
+
+def table_column_types(session, table):
+    """Column types of a table as reported by the PostgreSQL catalog, cached per table."""
+    types = table_column_types_cache.get(table)
+    if types is None:
+        types = dict(session.execute(table_column_types_query, {'table': table}).all())
+        table_column_types_cache[table] = types
+    return types
+
+def update_fragment(prefix, table, key_column, keys, row_count, types, returning):
+    """Build the data-modifying CTE updating row_count rows with the same columns; parameters are namespaced by prefix.
+
+    Several rows are updated by a single UPDATE joined to a VALUES list. PostgreSQL types untyped VALUES entries
+    as text, so every entry is cast to the column type given in types ((column, type) pairs).
+    """
+    keys = sorted(keys)
+    returning_clause = ' RETURNING 1' if returning else ''
+    if row_count == 1:
+        assignments = ', '.join(f"{key} = :{prefix}_{key}" for key in keys)
+        return f"{prefix} AS (UPDATE {table} SET {assignments} WHERE {key_column} = :{prefix}_key{returning_clause})"
+
+    types = dict(types)
+    value_types = [('key', types[key_column]), *((key, types[key]) for key in keys)]
+    assignments = ', '.join(f"{key} = v.{key}" for key in keys)
+    values = ', '.join(
+        "(" + ', '.join(f"CAST(:{prefix}_{row}_{name} AS {value_type})" for name, value_type in value_types) + ")"
+        for row in range(row_count)
+    )
+    return (
+        f"{prefix} AS (UPDATE {table} SET {assignments} FROM (VALUES {values}) AS v(__key, {', '.join(keys)}) "
+        f"WHERE {table}.{key_column} = v.__key{returning_clause})"
+    )
+
+@functools.lru_cache(maxsize=256)
+def fetch_rows_query(targets):
+    """Compile a single SELECT returning, as JSON text, the row of each (table, key column) target."""
+    rows = ", ".join(
+        f"(SELECT CAST(row_to_json(t) AS text) FROM {table} AS t WHERE t.{key_column} = :row{index}) AS row{index}"
+        for index, (table, key_column) in enumerate(targets, 1)
+    )
+    return text(f"SELECT {rows}")
+
+def fetch_rows(session, targets):
+    """Fetch the rows of several (table, key column, key value) targets in one round-trip; missing rows are omitted.
+
+    The rows are decoded here rather than by psycopg2 so that numeric keys come back as exact Decimals instead of
+    floats; timestamp and uuid keys come back as strings, which PostgreSQL casts back when they are bound.
+    """
+    query = fetch_rows_query(tuple((table, key_column) for table, key_column, _ in targets))
+    params = {f"row{index}": key_value for index, (_, _, key_value) in enumerate(targets, 1)}
+    result = session.execute(query, params).fetchone()
+    return {target: json.loads(row, parse_float=Decimal) for target, row in zip(targets, result) if row is not None}
 
-def update_database(session, table_name, id_name, id_value, updated_record, parent_result=None):
-    mapped_columns = map_fields_to_columns(updated_record, RELATIONSHIPS[table_name])
+def plan_updates(session, root_table, root_column, root_id, updated_record, root_row):
+    """Walk the table plans level by level from the root table and collect the UPDATEs the record requires.
 
+    Rows are accumulated top-down by (table, key column, key value). A nested table's row is only needed when
+    there are foreign keys to follow from it, and all rows needed by one level are fetched in a single statement.
+    Updates hitting the same row are merged, as PostgreSQL applies only one modification per row and statement.
+    """
+    table_plans = load_config().table_plans
+    update_ops = {}
+    rows = {(root_table, root_column, root_id): root_row}
+    visited = set()
+    level = [(root_table, root_column, root_id)]
+
+    def add_update(table, key_column, key_value, columns):
+        row_key = (table, key_column, key_value)
+        if row_key in update_ops:
+            update_ops[row_key].columns.update(columns)
+        else:
+            update_ops[row_key] = UpdateOp(table, key_column, key_value, dict(columns))
+
+    while level:
+        pending = []
+        missing_rows = []
+        for target in level:
+            if target in visited:
+                continue
+            visited.add(target)
+            table_name, key_column, key_value = target
+
+            plan = table_plans[table_name]
+            mapped_columns = map_fields_to_columns(updated_record, plan)
+
+            # Direct fields of the table are updated by its own key
+            if mapped_columns.get(plan.table):
+                add_update(table_name, key_column, key_value, mapped_columns[plan.table])
+
+            # The row is only needed for its foreign keys: to update child fields or to descend further
+            if any(
+                relation.ref_table is not None
+                and (mapped_columns[relation.column] or relation.ref_table_name in table_plans)
+                for relation in plan.relations
+            ):
+                pending.append((target, plan, mapped_columns))
+                if target not in rows:
+                    missing_rows.append(target)
+
+        if missing_rows:
+            rows.update(fetch_rows(session, missing_rows))
+
+        level = []
+        for target, plan, mapped_columns in pending:
+            row = rows.get(target)
+            if row is None:
+                logger.error(f"No record found in {target[0]} with {target[1]} = {target[2]}")
+                continue
+
+            for relation in plan.relations:
+                if relation.ref_table is None:
+                    continue
+
+                # Get the foreign key value from the table's record
+                foreign_key_value = row.get(relation.column)
+                if foreign_key_value is None:
+                    logger.error(f"No related record found in {relation.ref_table_name} for foreign key {relation.column}")
+                    continue  # Skip updating this table
+
+                if mapped_columns[relation.column]:
+                    add_update(relation.ref_table_name, relation.ref_column, foreign_key_value, mapped_columns[relation.column])
+
+                # Nested relationships are visited on the next level with the related table's own record
+                if relation.ref_table_name in table_plans:
+                    level.append((relation.ref_table_name, relation.ref_column, foreign_key_value))
+
+    return list(update_ops.values())
+
+@functools.lru_cache(maxsize=512)
+def batch_update_query(shapes, count_rows):
+    """Compile the statement for a sequence of (table, key column, frozenset of columns, row count, column types)
+    UPDATE shapes.
+
+    With count_rows the statement returns the number of updated rows, which is only used for debug logging.
+    """
+    statements = [update_fragment(f"upd{index}", *shape, count_rows) for index, shape in enumerate(shapes, 1)]
+    if not count_rows:
+        return text(f"WITH {', '.join(statements)} SELECT 1")
+    updated_rows = " UNION ALL ".join(f"SELECT 1 FROM upd{index}" for index in range(1, len(statements) + 1))
+    return text(f"WITH {', '.join(statements)} SELECT count(*) FROM ({updated_rows}) AS updated")
+
+def batch_update_statement(session, update_ops, count_rows=False):
+    """Combine the UpdateOps into a single statement, optionally returning the number of updated rows.
+
+    Updates of several rows of a table setting the same columns are grouped into one UPDATE, typed from the
+    catalog; they stay separate UPDATEs if a column type cannot be found. The statement only depends on the
+    shape of the updates, so it is reused across requests.
+    """
+    groups = {}
+    for update_op in update_ops:
+        groups.setdefault((update_op.table, update_op.key_column, frozenset(update_op.columns)), []).append(update_op)
+
+    shapes = []
+    params = {}
+    for (table, key_column, keys), group in groups.items():
+        types = None
+        if len(group) > 1:
+            table_types = table_column_types(session, table)
+            if key_column in table_types and keys <= table_types.keys():
+                types = tuple((column, table_types[column]) for column in sorted({key_column, *keys}))
+
+        if types is None:
+            for update_op in group:
+                prefix = f"upd{len(shapes) + 1}"
+                shapes.append((table, key_column, keys, 1, None))
+                params.update({f"{prefix}_{key}": value for key, value in update_op.columns.items()})
+                params[f"{prefix}_key"] = update_op.key_value
+        else:
+            prefix = f"upd{len(shapes) + 1}"
+            shapes.append((table, key_column, keys, len(group), types))
+            for row, update_op in enumerate(group):
+                params.update({f"{prefix}_{row}_{key}": value for key, value in update_op.columns.items()})
+                params[f"{prefix}_{row}_key"] = update_op.key_value
+    return batch_update_query(tuple(shapes), count_rows), params
+
+def update_database(session, table_name, id_name, id_value, updated_record):
     try:
         # Start by fetching the main table's record to identify related records
-        schema, main_table = table_name.split('.')
         primary_key_column = id_name.split('.')[-1]
-
-        if parent_result is None:
-            fetch_query = f"SELECT * FROM {schema}.{main_table} WHERE {primary_key_column} = :id_value"
-            result = session.execute(text(fetch_query), {'id_value': id_value}).mappings().fetchone()
-        else:
-            result = parent_result
+        result = session.execute(fetch_row_query(table_name, primary_key_column), {'id_value': id_value}).mappings().fetchone()
 
         if not result:
             logger.error(f"No record found in {table_name} with {primary_key_column} = {id_value}")
             return False
 
-        # Dictionary to hold all updates for each related table
-        updates_per_table = {}
-
-        # Iterate over each related table defined in the relationships
-        for column, ref_table_info in RELATIONSHIPS[table_name].items():
-            ref_table = ref_table_info['ref']
-            related_schema, related_table, related_column = ref_table.split('.')
-            related_table_name = f"{related_schema}.{related_table}"
-
-            # Get the foreign key value from the main table's record
-            foreign_key_value = result.get(column)  # Access using .get() to avoid KeyError
-
-            if foreign_key_value is None:
-                logger.error(f"No related record found in {related_table_name} for foreign key {column}")
-                continue  # Skip updating this table
-
-            # Collect updates for each related table
-            if related_table_name not in updates_per_table:
-                updates_per_table[related_table_name] = []
-
-            # Get the fields to update in the related table
-            if column in mapped_columns:
-                updates_per_table[related_table_name].append({
-                    'columns': mapped_columns[column],
-                    'related_id': foreign_key_value,
-                    'related_column': related_column
-                })
-
-            # Check for nested relationships and recursively update them
-            if related_table_name in RELATIONSHIPS:
-                nested_success = update_database(
-                    session,
-                    related_table_name,
-                    f"{related_table}.{related_column}",
-                    foreign_key_value,
-                    updated_record,
-                    parent_result=result
-                )
-
-                if not nested_success:
-                    logger.error(f"Failed to update nested relationships for {related_table_name}")
-
-        # Execute updates for each related table
-        for related_table_name, updates in updates_per_table.items():
-            for update_info in updates:
-                columns = update_info['columns']
-                related_id = update_info['related_id']
-                related_column = update_info['related_column']
-
-                if columns:
-                    update_query = f"""
-                    UPDATE {related_table_name}
-                    SET {', '.join([f"{key} = :{key}" for key in columns.keys()])}
-                    WHERE {related_column} = :related_id
-                    """
-
-                    # Log the SQL query and parameters for debugging
-                    logger.debug(f"Executing SQL on table {related_table_name}: {update_query}")
-                    logger.debug(f"With parameters: {columns}")
-
-                    # Add the related_id to the parameters
-                    columns['related_id'] = related_id
-
-                    # Execute the update
-                    session.execute(text(update_query), columns)
+        update_ops = plan_updates(session, table_name, primary_key_column, id_value, updated_record, result)
+
+        if update_ops:
+            # All updates reach the database in a single round-trip; the updated rows are only
+            # counted when they are going to be logged
+            debug = logger.isEnabledFor(logging.DEBUG)
+            update_query, params = batch_update_statement(session, update_ops, count_rows=debug)
+
+            # Log the SQL query and parameters for debugging
+            logger.debug("Executing SQL: %s", update_query)
+            logger.debug("With parameters: %s", params)
+
+            update_result = session.execute(update_query, params)
+            if debug:
+                logger.debug("Updated %s row(s) related to %s", update_result.scalar(), table_name)
 
         # Commit the transaction after all updates
         session.commit()
 
-        # Re-fetch the record to ensure the update was successful
-        updated_result = session.execute(text(fetch_query), {'id_value': id_value}).mappings().fetchone()
-        logger.debug(f"Updated record after commit: {updated_result}")
-
-        logger.debug(f"Successfully updated records related to {table_name} with {primary_key_column} = {id_value}")
+        logger.debug("Successfully updated records related to %s with %s = %s", table_name, primary_key_column, id_value)
         return True
     except SQLAlchemyError as e:
         logger.error(f"Failed to update the record: {e}")
         session.rollback()
         return False
 
-def map_corrections_using_gpt(record, user_message):
-    prompt = f"""
-    The current database record is:
-    {json.dumps(record, indent=2)}
+FIELD_TYPE_SCHEMAS = {
+    "text": {"type": ["string", "null"]},
+    "date": {"type": ["string", "null"], "format": "date"},
+    "integer": {"type": ["integer", "null"]},
+    "numeric": {"type": ["number", "null"]},
+}
+
+def record_schema(relationships):
+    """Describe the record shape of a table (aliases, types and user terms) as a JSON schema."""
+    fields = []
+    for info in relationships.values():
+        if 'ref' in info:
+            fields.extend(info.get('fields', {}).values())
+        else:
+            fields.append(info)
+
+    properties = {}
+    for field in fields:
+        schema = dict(FIELD_TYPE_SCHEMAS.get(field.get('type'), {"type": ["string", "null"]}))
+        if field.get('terms'):
+            schema["description"] = f"Also referred to as: {', '.join(field['terms'])}"
+        properties[field['alias']] = schema
+
+    return {"type": "object", "properties": properties, "required": list(properties), "additionalProperties": False}
+
+@functools.lru_cache(maxsize=None)
+def system_prompt(table_name):
+    """Build the instructions for a table once; they form the stable prefix of every request for that table.
+
+    All per-request content (record and user message) goes after it in the user turn, so the prompt prefix is
+    identical across requests and eligible for the provider's prompt caching.
+    """
+    schema = dumps(record_schema(load_config().relationships[table_name]), orjson.OPT_INDENT_2).decode()
+    return f"""You keep a database record up to date from what a user tells you in natural language.
+
+Each request contains the current record as JSON after "RECORD:" and the user's input after "USER:".
+Update the record to reflect any changes stated or implied by the user's input and leave every other field as it is.
+Dates are written as YYYY-MM-DD.
+
+The record follows this JSON schema:
+{schema}
+
+Return only the updated JSON record, with exactly the same keys. If no changes are needed, return the original JSON
+record. Do not add any explanation or any text outside of the JSON object.
+
+Example:
+RECORD: {{"name": "John Doe", "email": "john.doe@example.com"}}
+USER: my email changed to jd@example.org
+{{"name": "John Doe", "email": "jd@example.org"}}"""
+
+def record_cache_key(record):
+    return hashlib.blake2b(dumps(record, orjson.OPT_SORT_KEYS)).hexdigest()
+
+def completion_cache_key(record_key, user_message):
+    return hashlib.blake2b(
+        record_key.encode() + b'|' + user_message.encode() + b'|' + openai_model.encode()
+    ).hexdigest()
+
+def post_to_openai(payload):
+    """Send the payload to OpenAI and return the streaming response, retrying with exponential backoff on rate
+    limiting and server errors. The caller must close the response."""
+    for attempt in range(OPENAI_MAX_RETRIES + 1):
+        openai_client = get_openai_client()
+        response = openai_client.send(openai_client.build_request("POST", openai_api_url, content=dumps(payload)), stream=True)
+        if response.status_code not in OPENAI_RETRY_STATUS_CODES or attempt == OPENAI_MAX_RETRIES:
+            return response
+        response.close()
+
+        retry_after = response.headers.get("Retry-After", "")
+        delay = float(retry_after) if retry_after.replace('.', '', 1).isdigit() else 0.5 * 2 ** attempt
+        delay = min(delay, OPENAI_MAX_RETRY_DELAY)
+        logger.warning(f"OpenAI API returned {response.status_code}, retrying in {delay}s")
+        sleep(delay)
+
+class JsonObjectScanner:
+    """Find the end of the first top-level JSON object in text that arrives in chunks.
+
+    Tracks brace depth while skipping braces inside strings (including escaped quotes), so the object can be
+    handed to the JSON parser as soon as its closing brace arrives. Strings are tracked from the start of the
+    text, so a brace quoted in prose before the object does not start it.
+    """
+    def __init__(self):
+        self.buffer = ""
+        self.position = 0
+        self.start = None
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+
+    def feed(self, chunk):
+        """Add a chunk; return the text of the object once it is complete, otherwise None."""
+        self.buffer += chunk
+        for index in range(self.position, len(self.buffer)):
+            char = self.buffer[index]
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == '\\':
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char == '{':
+                if self.start is None:
+                    self.start = index
+                self.depth += 1
+            elif char == '}' and self.start is not None:
+                self.depth -= 1
+                if self.depth == 0:
+                    return self.buffer[self.start:index + 1]
+        self.position = len(self.buffer)
+        return None
+
+def read_streamed_object(response):
+    """Read the completion's server-sent events until the first top-level JSON object is complete."""
+    scanner = JsonObjectScanner()
+    for line in response.iter_lines():
+        if not line.startswith("data:"):
+            continue
+        data = line[len("data:"):].strip()
+        if data == "[DONE]":
+            break
+        chunk = orjson.loads(data)
+        choices = chunk.get('choices') if isinstance(chunk, dict) else None
+        content = choices[0].get('delta', {}).get('content') if choices else None
+        if content:
+            corrections_text = scanner.feed(content)
+            if corrections_text is not None:
+                return corrections_text
+    return None
+
+def changes_stated_in_message(changes, user_message):
+    """Whether every new value of semantically cached changes literally appears in the user's message.
+
+    Messages differing only in their values ("change email to a@x.com" / "... to b@y.com") embed almost
+    identically, so a cached hit is only trusted when the message itself states the values it would write.
+    """
+    message = user_message.casefold()
+    return all(value is not None and str(value).casefold() in message for value in changes.values())
 
-    The user provided the following input: '{user_message}'.
+def map_corrections_using_gpt(table_name, record, user_message, use_cache=True, message_embedding=None):
+    """Ask OpenAI for the record updated with the user's message, serving it from the caches when possible.
 
-    Please update the JSON record to reflect any changes based on the user's input.
-    **Return only the updated JSON record. If no changes are needed, return the original JSON record without any additional text.**
+    message_embedding is an optional future of the message's semantic cache embedding, started by the caller
+    while the record was being fetched.
     """
+    record_key = record_cache_key(record)
+    cache_key = completion_cache_key(record_key, user_message)
+    if use_cache:
+        with completions_cache_lock:
+            cached = completions_cache.get(cache_key)
+        if cached is not None:
+            logger.debug("Using cached corrections for key %s", cache_key)
+            if message_embedding is not None:
+                message_embedding.cancel()
+            return cached[0], None
+
+    embedding = None
+    if use_cache and corrections_semantic_cache is not None:
+        # The semantic cache is only an optimization: on any failure fall through to OpenAI
+        try:
+            if message_embedding is not None:
+                embedding = message_embedding.result()
+            else:
+                embedding = corrections_semantic_cache.embed(user_message)
+            changes = corrections_semantic_cache.lookup(table_name, embedding)
+        except Exception as e:
+            logger.error(f"Semantic cache lookup failed: {e}")
+            embedding = changes = None
+        if changes is not None and not changes_stated_in_message(changes, user_message):
+            logger.debug("Ignoring semantically cached changes not stated in the message: %s", changes)
+            changes = None
+        if changes is not None:
+            logger.debug("Using semantically cached changes: %s", changes)
+            return {**record, **changes}, None
 
     payload = {
-        "model": "gpt-4",
+        "model": openai_model,
         "messages": [
-            {"role": "system", "content": "You are a helpful assistant."},
-            {"role": "user", "content": prompt}
+            {"role": "system", "content": system_prompt(table_name)},
+            {"role": "user", "content": f"RECORD: {dumps(record).decode()}\nUSER: {user_message}"}
         ],
-        "temperature": 0.7
+        "temperature": 0.7,
+        "stream": True
     }
 
-    logger.debug(f"Sending payload to OpenAI: {json.dumps(payload, indent=2)}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Sending payload to OpenAI: %s", dumps(payload, orjson.OPT_INDENT_2).decode())
 
-    response = requests.post(openai_api_url, headers=headers, data=json.dumps(payload))
+    try:
+        response = post_to_openai(payload)
+        try:
+            if response.status_code == 200:
+                # Stop reading as soon as the JSON record is complete instead of waiting for the whole completion
+                corrections_text = read_streamed_object(response)
+            else:
+                response.read()
+        finally:
+            response.close()
+    except httpx.HTTPError as e:
+        logger.error(f"OpenAI API request failed: {e}")
+        return None, "OpenAI API request failed"
+    except orjson.JSONDecodeError as e:
+        logger.error(f"Failed to parse streamed response from OpenAI: {e}")
+        return None, "Failed to parse corrections"
 
     if response.status_code == 200:
-        corrections_text = response.json()['choices'][0]['message']['content'].strip()
-        logger.debug(f"Received response from OpenAI: {corrections_text}")
+        logger.debug("Received response from OpenAI: %s", corrections_text)
+        if corrections_text is None:
+            logger.error("No JSON object in the response from OpenAI")
+            return None, "Failed to parse corrections"
 
         try:
-            corrections = json.loads(corrections_text)
+            corrections = orjson.loads(corrections_text)
             if isinstance(corrections, dict):  # Check if the response is a valid JSON object
+                with completions_cache_lock:
+                    completions_cache[cache_key] = (corrections,)
+                changes = {key: value for key, value in corrections.items() if record.get(key) != value}
+                # Empty changes are not stored: served to another record they would skip a correction it needs
+                if embedding is not None and changes:
+                    try:
+                        corrections_semantic_cache.store(table_name, embedding, changes)
+                    except Exception as e:
+                        logger.error(f"Failed to store corrections in the semantic cache: {e}")
                 return corrections, None
             else:
                 logger.error("Received non-JSON object from OpenAI")
                 return None, "Received non-JSON object"
-        except json.JSONDecodeError:
+        except orjson.JSONDecodeError:
             logger.error("Failed to parse JSON response from OpenAI")
             return None, "Failed to parse corrections"
     else:
         logger.error(f"OpenAI API request failed with status code {response.status_code}: {response.text}")
         return None, f"OpenAI API request failed: {response.status_code}"
 
-def generate_response(record):
+def generate_response(record, plan):
+    pretty_names = plan.pretty_names
     response_text = "I have now in my records the following: " + ". ".join(
-        f"{key.capitalize().replace('_', ' ')} is {value}" for key, value in record.items() if value is not None
+        f"{pretty_names[key] if key in pretty_names else pretty_name(key)} is {value}"
+        for key, value in record.items() if value is not None
     ) + ". If you need modifications, please state them. Otherwise, we thank you for completing your record."
     return response_text
 
+@app.before_request
+def open_session():
+    g.session = Session(bind=get_engine())
+
+@app.teardown_request
+def close_session(exception=None):
+    session = g.pop('session', None)
+    if session is not None:
+        session.close()
+
 @app.route("/message", methods=["POST"])
 def message():
-    data = request.json
+    data = request.get_json(silent=True) or {}
     user_message = data.get("message")
     id_name = request.args.get("id_name")
     id_value = request.args.get("id_value")
+    use_cache = request.args.get("nocache") != "1"
     table_name = "bookings.transfer_services"
     
     if not id_name or not id_value:
         return jsonify({"response": "id_name and id_value are required."}), 400
+    if not isinstance(user_message, str) or not user_message.strip():
+        return jsonify({"response": "message is required."}), 400
     
     logger.info(f"Received message: {user_message} with id_name: {id_name} and id_value: {id_value}")
     
-    session = Session()
+    # Embed the message for the semantic cache while the record is fetched, as it does not depend on it
+    message_embedding = None
+    if use_cache and corrections_semantic_cache is not None:
+        message_embedding = embedding_executor.submit(corrections_semantic_cache.embed, user_message)
+
+    session = g.session
     current_record, error = process_message(session, table_name, id_name, id_value)
     
+    if (error or not current_record) and message_embedding is not None:
+        message_embedding.cancel()
     if error:
-        session.close()
         return jsonify({"response": error}), 500
     if not current_record:
-        session.close()
         return jsonify({"response": "No record found."}), 404
 
     # Generate corrections
-    corrections, error = map_corrections_using_gpt(current_record, user_message)
+    corrections, error = map_corrections_using_gpt(
+        table_name, current_record, user_message, use_cache=use_cache, message_embedding=message_embedding
+    )
 
     if corrections:
         # Update the database with the new record
         success = update_database(session, table_name, id_name, id_value, corrections)
-        session.close()
         
         if success:
             # Respond with the updated record
             updated_record = {**current_record, **corrections}
-            response_text = generate_response(updated_record)
+            response_text = generate_response(updated_record, load_config().table_plans[table_name])
             return jsonify({"response": response_text})
         else:
             return jsonify({"response": "Failed to update the record in the database."}), 500
 
     else:
-        session.close()
         if error:
             return jsonify({"response": "Failed to process the corrections. Please try again."}), 500
         else:
             # No corrections were made, so respond with the current record
-            response_text = generate_response(current_record)
+            response_text = generate_response(current_record, load_config().table_plans[table_name])
             return jsonify({"response": response_text})
 
 if __name__ == '__main__':
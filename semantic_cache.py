@@ -0,0 +1,103 @@
+"""Semantic cache of the corrections returned by OpenAI.
+
+Users phrase the same correction in many ways ("change phone to X", "update the phone number to X"), which the
+exact-match completions cache in app.py cannot catch. This cache embeds the user message with a local sentence
+embedding model (all-MiniLM-L6-v2 exported to ONNX, run on CPU) and serves the changes of the most similar
+earlier message sent against the same table, above a cosine similarity threshold. Entries are kept in SQLite, searched
+with the sqlite-vec extension and namespaced by table name.
+
+The embedding only depends on the message, so it can be computed while the record is still being fetched.
+
+Entries are not tied to a record: the record changes as soon as a correction is applied, so keying them by its
+contents would make every entry unreachable right after it is stored. Only the fields a correction changed are stored,
+and a hit is applied on top of the record it is served for.
+
+Requires numpy, onnxruntime, tokenizers and sqlite-vec.
+"""
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+import onnxruntime
+import orjson
+import sqlite_vec
+from tokenizers import Tokenizer
+
+
+class SemanticCache:
+    def __init__(self, path, model_dir, threshold=0.95, ttl=7 * 24 * 3600):
+        """Open (or create) the cache database at path and load model.onnx and tokenizer.json from model_dir."""
+        self.threshold = threshold
+        self.ttl = ttl
+        self.lock = threading.Lock()
+
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=256)
+        self.model = onnxruntime.InferenceSession(
+            os.path.join(model_dir, "model.onnx"), providers=["CPUExecutionProvider"]
+        )
+        self.model_inputs = {model_input.name for model_input in self.model.get_inputs()}
+
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.enable_load_extension(True)
+        sqlite_vec.load(self.db)
+        self.db.enable_load_extension(False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS cached_changes (namespace TEXT NOT NULL, embedding BLOB NOT NULL, "
+            "changes TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS cached_changes_namespace ON cached_changes (namespace, expires_at)"
+        )
+        self.db.commit()
+
+    def embed(self, text):
+        """Return the L2-normalized, mean-pooled float32 embedding of text."""
+        encoding = self.tokenizer.encode(text)
+        attention_mask = np.array([encoding.attention_mask], dtype=np.int64)
+        inputs = {
+            "input_ids": np.array([encoding.ids], dtype=np.int64),
+            "attention_mask": attention_mask,
+        }
+        if "token_type_ids" in self.model_inputs:
+            inputs["token_type_ids"] = np.array([encoding.type_ids], dtype=np.int64)
+
+        token_embeddings = self.model.run(None, inputs)[0]
+        mask = attention_mask[..., None]
+        embedding = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        embedding /= np.linalg.norm(embedding, axis=1, keepdims=True)
+        return embedding[0].astype(np.float32)
+
+    def lookup(self, namespace, embedding):
+        """Return the changes of the closest live entry in namespace, or None when nothing is similar enough."""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT changes, vec_distance_cosine(embedding, ?) AS distance FROM cached_changes "
+                "WHERE namespace = ? AND expires_at > ? ORDER BY distance LIMIT 1",
+                (embedding.tobytes(), namespace, time.time())
+            ).fetchone()
+
+        if row is None or 1 - row[1] < self.threshold:
+            return None
+        return orjson.loads(row[0])
+
+    def store(self, namespace, embedding, changes):
+        now = time.time()
+        with self.lock:
+            self.db.execute("DELETE FROM cached_changes WHERE expires_at <= ?", (now,))
+            self.db.execute(
+                "INSERT INTO cached_changes (namespace, embedding, changes, expires_at) VALUES (?, ?, ?, ?)",
+                (namespace, embedding.tobytes(), orjson.dumps(changes, default=str).decode(), now + self.ttl)
+            )
+            self.db.commit()
+
+
+def from_env():
+    """Build the cache from the SEMANTIC_CACHE_* environment variables."""
+    return SemanticCache(
+        os.environ.get("SEMANTIC_CACHE_PATH", "semantic_cache.db"),
+        os.environ["SEMANTIC_CACHE_MODEL_DIR"],
+        threshold=float(os.environ.get("SEMANTIC_CACHE_THRESHOLD", "0.95")),
+    )
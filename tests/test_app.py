@@ -0,0 +1,387 @@
+from concurrent.futures import Future
+from datetime import date, datetime, time, timedelta, timezone
+from decimal import Decimal
+import re
+
+import orjson
+import pytest
+
+import app
+from app import JsonObjectScanner, dumps, record_cache_key
+
+
+@pytest.fixture(autouse=True)
+def clear_completions_cache():
+    app.completions_cache.clear()
+
+
+def scan(*chunks):
+    scanner = JsonObjectScanner()
+    for chunk in chunks:
+        result = scanner.feed(chunk)
+        if result is not None:
+            return result
+    return None
+
+
+def test_scanner_returns_plain_object():
+    assert scan('{"a": 1}') == '{"a": 1}'
+
+
+def test_scanner_ignores_code_fences():
+    text = scan('Here you go:\n```json\n{"book title": "Dune"}\n```')
+    assert orjson.loads(text) == {"book title": "Dune"}
+
+
+def test_scanner_ignores_braces_in_strings_and_escaped_quotes():
+    text = scan('{"a": "x}\\"{", "b": {"c": 1}} trailing')
+    assert orjson.loads(text) == {"a": 'x}"{', "b": {"c": 1}}
+
+
+def test_scanner_ignores_quoted_brace_before_object():
+    text = scan('Sure "{" here {"a":"}"}')
+    assert orjson.loads(text) == {"a": "}"}
+
+
+def test_scanner_handles_chunk_boundaries():
+    chunks = ['Sure: ```json\n{"a": "x}', '\\', '"{", "b": {"c', '": 1}', '}\n```']
+    assert orjson.loads(scan(*chunks)) == {"a": 'x}"{', "b": {"c": 1}}
+
+
+def test_scanner_waits_for_incomplete_object():
+    assert scan('{"a": {"b": 1}', ' ') is None
+
+
+def test_dumps_handles_database_values():
+    record = {
+        "return date": date(2024, 8, 15),
+        "borrowed at": datetime(2024, 8, 1, 9, 30),
+        "opens at": time(9, 0, tzinfo=timezone.utc),
+        "loan period": timedelta(days=14),
+        "fee": Decimal("12.50"),
+        "cover": b"\x00",
+    }
+    assert orjson.loads(dumps(record)) == {
+        "return date": "2024-08-15",
+        "borrowed at": "2024-08-01T09:30:00",
+        "opens at": "09:00:00+00:00",
+        "loan period": "P14D",
+        "fee": 12.5,
+        "cover": "AA==",
+    }
+    assert orjson.loads(dumps({"cover": memoryview(b"\x00"), "late by": timedelta(hours=2, minutes=30)})) == {
+        "cover": "AA==",
+        "late by": "P0DT2H30M",
+    }
+    assert record_cache_key(record) == record_cache_key(dict(reversed(record.items())))
+    with pytest.raises(TypeError):
+        dumps({"tags": {"fiction"}})
+
+
+class FailingSemanticCache:
+    def embed(self, text):
+        raise RuntimeError("embedding model unavailable")
+
+    def lookup(self, namespace, embedding):
+        raise AssertionError("lookup must not run without an embedding")
+
+
+def test_semantic_cache_failure_falls_through_to_openai(monkeypatch):
+    requests_sent = []
+
+    def fail_openai(payload):
+        requests_sent.append(payload)
+        raise app.httpx.ConnectError("offline")
+
+    monkeypatch.setattr(app, "corrections_semantic_cache", FailingSemanticCache())
+    monkeypatch.setattr(app, "system_prompt", lambda table_name: "instructions")
+    monkeypatch.setattr(app, "post_to_openai", fail_openai)
+
+    failed_embedding = Future()
+    failed_embedding.set_exception(RuntimeError("embedding model unavailable"))
+    for message_embedding in (failed_embedding, None):
+        corrections, error = app.map_corrections_using_gpt(
+            "library.transactions", {"user name": "John"}, "I am Jane", message_embedding=message_embedding
+        )
+        assert (corrections, error) == (None, "OpenAI API request failed")
+    assert len(requests_sent) == 2
+
+
+class CatalogSession:
+    """Stands in for a session, answering only the column type lookup of batch_update_statement."""
+    def __init__(self, types):
+        self.types = types
+
+    def execute(self, query, params):
+        assert query is app.table_column_types_query
+        return self
+
+    def all(self):
+        return list(self.types.items())
+
+
+def test_batch_update_casts_every_values_entry(monkeypatch):
+    monkeypatch.setattr(app, "table_column_types_cache", {})
+    session = CatalogSession({"id": "integer", "zip": "integer", "city": "text"})
+    for zips in (("11111", "22222"), (None, None)):
+        update_ops = [
+            app.UpdateOp("bookings.addresses", "id", 1, {"zip": zips[0], "city": None}),
+            app.UpdateOp("bookings.addresses", "id", 2, {"zip": zips[1], "city": "Boston"}),
+        ]
+        query, params = app.batch_update_statement(session, update_ops)
+        assert "FROM (VALUES (CAST(:upd1_0_key AS integer), CAST(:upd1_0_city AS text), CAST(:upd1_0_zip AS integer)), " \
+               "(CAST(:upd1_1_key AS integer), CAST(:upd1_1_city AS text), CAST(:upd1_1_zip AS integer))) " \
+               "AS v(__key, city, zip)" in query.text
+        assert "SET city = v.city, zip = v.zip" in query.text
+        assert params == {
+            "upd1_0_key": 1, "upd1_0_zip": zips[0], "upd1_0_city": None,
+            "upd1_1_key": 2, "upd1_1_zip": zips[1], "upd1_1_city": "Boston",
+        }
+
+
+def test_batch_update_without_known_types_uses_one_update_per_row(monkeypatch):
+    monkeypatch.setattr(app, "table_column_types_cache", {})
+    session = CatalogSession({"id": "integer"})
+    update_ops = [
+        app.UpdateOp("bookings.addresses", "id", 1, {"zip": "11111"}),
+        app.UpdateOp("bookings.addresses", "id", 2, {"zip": None}),
+    ]
+    query, params = app.batch_update_statement(session, update_ops)
+    assert "VALUES" not in query.text
+    assert "upd1 AS (UPDATE bookings.addresses SET zip = :upd1_zip WHERE id = :upd1_key)" in query.text
+    assert "upd2 AS (UPDATE bookings.addresses SET zip = :upd2_zip WHERE id = :upd2_key)" in query.text
+    assert params == {"upd1_zip": "11111", "upd1_key": 1, "upd2_zip": None, "upd2_key": 2}
+
+
+def test_message_requires_a_message(monkeypatch):
+    monkeypatch.setattr(app, "get_engine", lambda: None)
+    client = app.app.test_client()
+    url = "/message?id_name=library.transactions.id&id_value=1"
+    for body in ({}, {"message": None}, {"message": 42}, {"message": "  "}):
+        response = client.post(url, json=body)
+        assert response.status_code == 400
+        assert response.get_json() == {"response": "message is required."}
+    assert client.post(url, data="not json", content_type="text/plain").status_code == 400
+
+
+class FakeStreamResponse:
+    """A streamed OpenAI response sending the given content as server-sent events."""
+    status_code = 200
+
+    def __init__(self, *lines):
+        self.lines = lines
+
+    @classmethod
+    def with_content(cls, content):
+        chunk = orjson.dumps({"choices": [{"delta": {"content": content}}]}).decode()
+        return cls(f"data: {chunk}", "data: [DONE]")
+
+    def iter_lines(self):
+        return iter(self.lines)
+
+    def read(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class StubSemanticCache:
+    """Semantic cache whose embedder maps every message to the same vector, so any lookup is a hit."""
+    def __init__(self):
+        self.entries = {}
+
+    def embed(self, text):
+        return (1.0, 0.0)
+
+    def lookup(self, namespace, embedding):
+        return self.entries.get((namespace, embedding))
+
+    def store(self, namespace, embedding, changes):
+        self.entries[(namespace, embedding)] = changes
+
+
+def test_semantic_hit_with_other_values_is_a_miss(monkeypatch):
+    answers = iter(['{"user email": "a@x.com"}', '{"user email": "b@y.com"}'])
+    requests_sent = []
+
+    def fake_openai(payload):
+        requests_sent.append(payload)
+        return FakeStreamResponse.with_content(next(answers))
+
+    monkeypatch.setattr(app, "corrections_semantic_cache", StubSemanticCache())
+    monkeypatch.setattr(app, "system_prompt", lambda table_name: "instructions")
+    monkeypatch.setattr(app, "post_to_openai", fake_openai)
+
+    record = {"user email": "john@example.com"}
+    assert app.map_corrections_using_gpt("library.transactions", record, "change email to a@x.com") == (
+        {"user email": "a@x.com"}, None
+    )
+    assert app.map_corrections_using_gpt("library.transactions", record, "change email to b@y.com") == (
+        {"user email": "b@y.com"}, None
+    )
+    assert len(requests_sent) == 2
+
+    # A differently phrased message stating the cached value is served from the semantic cache
+    assert app.map_corrections_using_gpt("library.transactions", record, "my email is now B@Y.com") == (
+        {"user email": "b@y.com"}, None
+    )
+    assert len(requests_sent) == 2
+
+
+def test_semantic_hit_survives_the_record_update(monkeypatch):
+    answers = iter(['{"user name": "John", "user email": "a@x.com"}', '{"user name": "Jane", "user email": "a@x.com"}'])
+    requests_sent = []
+
+    def fake_openai(payload):
+        requests_sent.append(payload)
+        return FakeStreamResponse.with_content(next(answers))
+
+    monkeypatch.setattr(app, "corrections_semantic_cache", StubSemanticCache())
+    monkeypatch.setattr(app, "system_prompt", lambda table_name: "instructions")
+    monkeypatch.setattr(app, "post_to_openai", fake_openai)
+
+    record = {"user name": "John", "user email": "john@example.com"}
+    updated_record, _ = app.map_corrections_using_gpt("library.transactions", record, "change email to a@x.com")
+    # The record now reads differently, the cached changes still apply to it
+    assert app.map_corrections_using_gpt("library.transactions", updated_record, "set my email to a@x.com") == (
+        {"user name": "John", "user email": "a@x.com"}, None
+    )
+    assert len(requests_sent) == 1
+
+    # A correction that changed nothing is not cached, so it cannot stand in for one that would
+    monkeypatch.setattr(app, "corrections_semantic_cache", StubSemanticCache())
+    record = {"user name": "Jane", "user email": "a@x.com"}
+    assert app.map_corrections_using_gpt("library.transactions", record, "my email is a@x.com") == (record, None)
+    assert app.corrections_semantic_cache.entries == {}
+
+
+def test_malformed_stream_fails_to_parse(monkeypatch):
+    monkeypatch.setattr(app, "system_prompt", lambda table_name: "instructions")
+    for response in (FakeStreamResponse("data: {not json"), FakeStreamResponse("data: [1, 2]", "data: [DONE]")):
+        monkeypatch.setattr(app, "post_to_openai", lambda payload: response)
+        assert app.map_corrections_using_gpt(
+            "library.transactions", {"user name": "John"}, "I am Jane", use_cache=False
+        ) == (None, "Failed to parse corrections")
+
+
+TRANSACTIONS = {
+    "library.transactions": {
+        "user_id": {"ref": "library.users.id", "fields": {"name": {"type": "text", "alias": "user name"}}},
+        "borrow_date": {"type": "date", "alias": "borrow date"},
+        "fee": {"type": "numeric", "alias": "fee"},
+    }
+}
+
+
+class RowSession:
+    """Stands in for a session whose record query returns a single row."""
+    def __init__(self, row):
+        self.row = row
+
+    def execute(self, query, params):
+        return self
+
+    def mappings(self):
+        return self
+
+    def fetchone(self):
+        return self.row
+
+
+def test_process_message_serializes_the_record(monkeypatch):
+    plans = {table: app.build_table_plan(table, relationships) for table, relationships in TRANSACTIONS.items()}
+    monkeypatch.setattr(app, "load_config", lambda: app.Config("", TRANSACTIONS, {}, plans))
+    monkeypatch.setattr(app, "construct_query", lambda table, id_name: None)
+    row = {"user name": "John", "borrow date": datetime(2024, 8, 1, 9, 30), "fee": Decimal("12.50")}
+    record, error = app.process_message(RowSession(row), "library.transactions", "id", "1")
+    assert error is None
+    assert list(record.items()) == [("user name", "John"), ("borrow date", "2024-08-01T09:30:00"), ("fee", 12.5)]
+
+    record, error = app.process_message(RowSession({**row, "fee": {"fiction"}}), "library.transactions", "id", "1")
+    assert (record, error) == (None, "Unsupported column type.")
+
+
+def test_exact_hit_cancels_the_pending_embedding(monkeypatch):
+    monkeypatch.setattr(app, "corrections_semantic_cache", StubSemanticCache())
+    record = {"user name": "John"}
+    app.completions_cache[app.completion_cache_key(record_cache_key(record), "I am Jane")] = ({"user name": "Jane"},)
+    message_embedding = Future()
+    assert app.map_corrections_using_gpt(
+        "library.transactions", record, "I am Jane", message_embedding=message_embedding
+    ) == ({"user name": "Jane"}, None)
+    assert message_embedding.cancelled()
+
+
+NESTED_RELATIONSHIPS = {
+    "library.transactions": {
+        "user_id": {"ref": "library.users.id", "fields": {"name": {"type": "text", "alias": "user name"}}},
+        "book_id": {"ref": "library.books.id", "fields": {"title": {"type": "text", "alias": "book title"}}},
+        "return_date": {"type": "date", "alias": "return date"},
+    },
+    "library.users": {
+        "address_code": {"ref": "library.addresses.code", "fields": {"city": {"type": "text", "alias": "user city"}}},
+        "email": {"type": "text", "alias": "user email"},
+    },
+}
+
+
+class RowsSession:
+    """Stands in for a session, answering the batched row fetches of plan_updates from JSON rows."""
+    def __init__(self, rows):
+        self.rows = rows
+        self.fetched = []
+
+    def execute(self, query, params):
+        targets = re.findall(r"FROM (\S+) AS t WHERE t\.(\w+) = :(row\d+)", query.text)
+        self.fetched.append([(table, key_column, params[param]) for table, key_column, param in targets])
+        self.result = tuple(self.rows.get(target) for target in self.fetched[-1])
+        return self
+
+    def fetchone(self):
+        return self.result
+
+
+@pytest.fixture
+def nested_config(monkeypatch):
+    plans = {table: app.build_table_plan(table, relationships) for table, relationships in NESTED_RELATIONSHIPS.items()}
+    monkeypatch.setattr(app, "load_config", lambda: app.Config("", NESTED_RELATIONSHIPS, {}, plans))
+
+
+def test_plan_updates_walks_nested_tables(nested_config):
+    session = RowsSession({("library.users", "id", 7): '{"id": 7, "address_code": 10.50, "email": "j@x.com"}'})
+    root_row = {"id": 1, "user_id": 7, "book_id": 3, "return_date": date(2024, 8, 15)}
+    updated_record = {"user name": "Jane", "user email": "jane@x.com", "user city": "Boston", "return date": "2024-08-20"}
+    update_ops = app.plan_updates(session, "library.transactions", "id", 1, updated_record, root_row)
+
+    # The users row is fetched once, on the second level, and its numeric key is decoded exactly
+    assert session.fetched == [[("library.users", "id", 7)]]
+    assert [(op.table, op.key_column, op.key_value, op.columns) for op in update_ops] == [
+        ("library.transactions", "id", 1, {"return_date": "2024-08-20"}),
+        # The child field reached from transactions and the direct field of users hit the same row
+        ("library.users", "id", 7, {"name": "Jane", "email": "jane@x.com"}),
+        ("library.addresses", "code", Decimal("10.50"), {"city": "Boston"}),
+    ]
+    assert isinstance(update_ops[2].key_value, Decimal)
+
+
+def test_plan_updates_skips_missing_nested_rows(nested_config):
+    session = RowsSession({})
+    root_row = {"id": 1, "user_id": 7, "book_id": 3}
+    update_ops = app.plan_updates(
+        session, "library.transactions", "id", 1, {"user email": "jane@x.com", "user city": "Boston"}, root_row
+    )
+    assert session.fetched == [[("library.users", "id", 7)]]
+    assert [(op.table, op.key_value, op.columns) for op in update_ops] == [
+        ("library.users", 7, {"email": "jane@x.com"}),
+    ]
+
+
+def test_plan_updates_does_not_fetch_rows_without_mapped_child_fields(nested_config):
+    session = RowsSession({})
+    root_row = {"id": 1, "user_id": 7, "book_id": 3}
+    update_ops = app.plan_updates(session, "library.transactions", "id", 1, {"user email": "jane@x.com"}, root_row)
+    assert session.fetched == []
+    assert [(op.table, op.key_value, op.columns) for op in update_ops] == [
+        ("library.users", 7, {"email": "jane@x.com"}),
+    ]
@@ -0,0 +1,20 @@
+"""WSGI entry point for serving the app under gunicorn's gevent worker.
+
+    gunicorn -k gevent -w 4 --worker-connections 1000 wsgi:app
+
+Patching must happen before anything else is imported so that sockets, threads and
+the requests/OpenAI HTTP calls yield to other greenlets instead of blocking the worker.
+psycopg2 is a C extension that bypasses the patched socket module; psycogreen installs
+a wait callback so database waits yield as well. Any other C extension doing blocking
+I/O on the request path would still stall the whole worker, so keep the hot path free
+of un-patched native I/O.
+"""
+from gevent import monkey
+
+monkey.patch_all()
+
+from psycogreen.gevent import patch_psycopg  # noqa: E402
+
+patch_psycopg()
+
+from app import app  # noqa: E402,F401